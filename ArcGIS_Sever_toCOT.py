@@ -1,21 +1,53 @@
 import json
 import xml.etree.ElementTree as ET
-from arcgis.gis import GIS
 from datetime import datetime, timedelta
-import socket
-import ssl
 import time
 import requests
 import os
+from cot_cycle import call_upstream, run_cycles, save_checkpoint, send_tls, send_to_destinations, send_udp
+from cot_mesh import MESH_MAX_DATAGRAM
+from cot_routing import query_envelope, route_cot_messages
 
 OUTPUT_DIR = r"G:\\PY\\Fire COT"
 
+FEATURE_SERVICE_URL = "https://cfs.geohub.sa.gov.au/server/rest/services/CFS_Incident_Read/CFS_Incidents/FeatureServer/0/query"
+FEATURE_SERVICE_TIMEOUT = 60  # seconds to wait on the feature service before the fetch fails
+
 CERT_FILE = r"\\Path\\to\\your\\crt.pem" #path to your cert
 KEY_FILE = r"\\Path\\to\\your\\key.pem" #path to your key
 
 TAK_IP = "00.00.000.00" #specify your IP
 TAK_PORT = 8086 #specify port
 
+# Pooled HTTP session reused by every cycle
+HTTP_SESSION = requests.Session()
+
+OUTPUT_MODE = "tls"  # "tls" streams to TAK_IP, "udp" pushes to the SA mesh with no server
+
+# UDP / mesh SA output. Leave UDP_PEERS empty to use the standard SA multicast
+# group, or list unicast peers, e.g. [("127.0.0.1", 6969)] to test on loopback.
+UDP_MULTICAST_GROUP = ("239.2.3.1", 6969)
+UDP_PEERS = []
+UDP_MULTICAST_TTL = 1  # hops, raise if the mesh routes multicast
+UDP_MAX_DATAGRAM = MESH_MAX_DATAGRAM  # bytes, stays below a 1500 byte MTU after IP/UDP headers
+# Pack several XML events per datagram. Off by default: verify on a real receiver
+# that it parses every event in a datagram before enabling.
+UDP_BATCH_XML = False
+UDP_SEND_RATE = 50  # datagrams per second, 0 for no limit
+
+# Destinations and their areas of interest as (xmin, ymin, xmax, ymax) in WGS 84,
+# aoi None receives every incident. When every destination has an AOI the query
+# only asks the server for features inside their combined envelope.
+DESTINATIONS = [
+    {"name": "tak", "host": TAK_IP, "port": TAK_PORT, "aoi": None},
+]
+UDP_AOI = None  # area of interest for "udp" mode, where the mesh is the only destination
+AOI_GRID_SIZE = 0.5  # degrees per cell of the local spatial index
+
+# Checkpoint of the cycle in progress and the circuit breakers of its upstreams, see cot_cycle
+CHECKPOINT_FILE = os.path.join(OUTPUT_DIR, "cycle_checkpoint.json")
+BREAKERS = {}
+
 
 def unescape(s):
     s = s.replace("&lt;", "<")
@@ -25,7 +57,7 @@ def unescape(s):
 
 def fetch_fire_data():
     # URL of the feature service
-    url = "https://cfs.geohub.sa.gov.au/server/rest/services/CFS_Incident_Read/CFS_Incidents/FeatureServer/0/query"
+    url = FEATURE_SERVICE_URL
     # Parameters to query features
     params = {
         "f": "json",  # Specify output format as JSON
@@ -34,8 +66,17 @@ def fetch_fire_data():
         "returnGeometry": True  # Specify whether to return geometry
         # You can add more parameters as needed, such as spatial filters or result pagination
     }
+    envelope = query_envelope(active_destinations())
+    if envelope:
+        params.update({
+            "geometry": json.dumps(envelope),
+            "geometryType": "esriGeometryEnvelope",
+            "inSR": 4326,
+            "spatialRel": "esriSpatialRelIntersects"
+        })
     # Send request to get features
-    response = requests.get(url, params=params)
+    response = HTTP_SESSION.get(url, params=params, timeout=FEATURE_SERVICE_TIMEOUT)
+    response.raise_for_status()
     data = response.json()
     features = data["features"]
     return features
@@ -160,47 +201,43 @@ def save_cot_messages(cot_messages):
             file.write(cot_message_xml)
         print(f"Saved message to {filename}")
 
-def send_cot_messages(cot_messages):
-    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
-    context.load_cert_chain(certfile=CERT_FILE, keyfile=KEY_FILE)
-
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    ssl_sock = context.wrap_socket(sock, server_hostname=TAK_IP)
-
-    ssl_sock.connect((TAK_IP, TAK_PORT))
-
-    for cot_message in cot_messages:
-        cot_message_xml = ET.tostring(cot_message, encoding='utf-8', method='xml')
-        ssl_sock.sendall(cot_message_xml)
-        print("Sent message: ", cot_message_xml)
-
-    ssl_sock.close()
-    print("All messages sent successfully")
-
+def send_cot_messages(cot_messages, on_sent=None, destination=None):
+    host = destination["host"] if destination else TAK_IP
+    port = destination["port"] if destination else TAK_PORT
+    send_tls(cot_messages, on_sent, host, port, CERT_FILE, KEY_FILE)
+
+def send_cot_messages_udp(cot_messages, on_sent=None, destination=None):
+    send_udp(cot_messages, on_sent, UDP_PEERS or [UDP_MULTICAST_GROUP], UDP_MULTICAST_TTL,
+             UDP_MAX_DATAGRAM, UDP_BATCH_XML, UDP_SEND_RATE)
+
+def active_destinations():
+    if OUTPUT_MODE == "udp":
+        return [{"name": "mesh", "aoi": UDP_AOI}]
+    return DESTINATIONS
+
+def run_cycle(checkpoint):
+    # Each stage is skipped if the checkpoint already holds its output
+    if "features" not in checkpoint:
+        features = call_upstream(BREAKERS, "portal", fetch_fire_data)
+        checkpoint.update(created=time.time(), stage="fetched", features=features)
+        save_checkpoint(CHECKPOINT_FILE, checkpoint)
+
+    if "messages" not in checkpoint:
+        cot_messages = construct_cot_message(checkpoint["features"])
+        checkpoint.update(stage="built", messages=[ET.tostring(m, encoding='unicode') for m in cot_messages])
+        save_checkpoint(CHECKPOINT_FILE, checkpoint)
+
+    cot_messages = [ET.fromstring(m) for m in checkpoint["messages"]]
+    if checkpoint["stage"] != "sent":
+        destinations = active_destinations()
+        routes = route_cot_messages(cot_messages, destinations, AOI_GRID_SIZE)
+        send = send_cot_messages_udp if OUTPUT_MODE == "udp" else send_cot_messages
+        send_to_destinations(checkpoint, destinations, routes, send, BREAKERS)
+        save_checkpoint(CHECKPOINT_FILE, checkpoint)
+    #save_cot_messages(cot_messages)
 
 def main():
-    while True:
-        try:
-            # Fetch and process data
-            features = fetch_fire_data()
-            cot_messages = construct_cot_message(features)
-            send_cot_messages(cot_messages)
-            #save_cot_messages(cot_messages)
-            print("Messages sent. Restarting the script in 24 hours...")
-            
-            # Calculate the time until the next run (next day at the same time), if loaded into nssm this will continue running as a process
-            now = datetime.now()
-            next_run = now + timedelta(days=1)
-            next_run = next_run.replace(hour=0, minute=0, second=0, microsecond=0)
-            time_to_sleep = (next_run - now).total_seconds()
-            
-        except Exception as e:
-            print(f"Error: {e}")
-            # If an error occurs, try again in 30 min
-            time_to_sleep = 30 * 60
-        
-        # Sleep until the next run
-        time.sleep(time_to_sleep)
+    run_cycles(run_cycle, CHECKPOINT_FILE, BREAKERS, active_destinations)
 
 
 if __name__ == "__main__":
@@ -1,16 +1,19 @@
 import json
 import xml.etree.ElementTree as ET
-from arcgis.gis import GIS  # pip install arcgis (https://developers.arcgis.com/python/guide/intro/)
 from datetime import datetime, timedelta
-import socket
-import ssl
 import time
 import os
 import uuid
 import requests
-from arcgis.geometry import Geometry
-from arcgis.geometry.functions import simplify, generalize
+from arcgis.features import Feature
+from arcgis.geometry.filters import intersects
+from arcgis.geometry.functions import generalize
 from pyproj import Transformer
+from cot_geometry import LOD_TIERS, encode_polygon_events
+from cot_cycle import call_upstream, run_cycles, save_checkpoint, send_tls, send_to_destinations, send_udp
+from cot_mesh import MESH_MAX_DATAGRAM
+from cot_routing import query_envelope, route_cot_messages
+from cot_portal import FIRE_ITEM_ID, NoFeaturesError, get_feature_layer, reset_gis_session
 
 OUTPUT_DIR = r"path\\to\\Fire COT"
 
@@ -18,7 +21,35 @@ CERT_FILE = r"path\\to\\\\user.crt.pem"  # path to your cert
 KEY_FILE = r"path\\to\\user.key.pem"  # path to your key
 
 TAK_IP = "00.00.000.00"  # specify your IP
-TAK_PORT = ####  # specify port
+TAK_PORT = 8089  # specify port
+
+OUTPUT_MODE = "tls"  # "tls" streams to TAK_IP, "udp" pushes to the SA mesh with no server
+
+# UDP / mesh SA output. Leave UDP_PEERS empty to use the standard SA multicast
+# group, or list unicast peers, e.g. [("127.0.0.1", 6969)] to test on loopback.
+UDP_MULTICAST_GROUP = ("239.2.3.1", 6969)
+UDP_PEERS = []
+UDP_MULTICAST_TTL = 1  # hops, raise if the mesh routes multicast
+UDP_MAX_DATAGRAM = MESH_MAX_DATAGRAM  # bytes, the cot_geometry mesh tier is sized to fit one datagram
+# Pack several XML events per datagram. Off by default: verify on a real receiver
+# that it parses every event in a datagram before enabling.
+UDP_BATCH_XML = False
+UDP_SEND_RATE = 50  # datagrams per second, 0 for no limit
+UDP_LOD_TIER = "mesh"  # level of detail pushed over UDP, must be a protobuf encoded tier
+
+# Destinations, their areas of interest as (xmin, ymin, xmax, ymax) in WGS 84 and the
+# cot_geometry LOD tier each can handle. aoi None receives every incident. When every
+# destination has an AOI the query only asks the server for features inside their
+# combined envelope. Perimeters are built once per distinct tier.
+DESTINATIONS = [
+    {"name": "tak", "host": TAK_IP, "port": TAK_PORT, "aoi": None, "lod_tier": "medium"},
+]
+UDP_AOI = None  # area of interest for "udp" mode, where the mesh is the only destination
+AOI_GRID_SIZE = 0.5  # degrees per cell of the local spatial index
+
+# Checkpoint of the cycle in progress and the circuit breakers of its upstreams, see cot_cycle
+CHECKPOINT_FILE = os.path.join(OUTPUT_DIR, "cycle_checkpoint.json")
+BREAKERS = {}
 
 def unescape(s):
     s = s.replace("&lt;", "<")
@@ -26,22 +57,22 @@ def unescape(s):
     s = s.replace("&amp;", "&")
     return s
 
-
-
 def fetch_fire_data():
     try:
         # Connect to the ArcGIS Online account
-        gis = GIS(url="https://geospatial.alberta.ca/portal")
-        item = gis.content.get("0b775584ff2e4e2a8f0689a339614258")
-        feature_layer = item.layers[3]
+        feature_layer = get_feature_layer(FIRE_ITEM_ID, 3)
         
         # Query features and retrieve attributes
         fire_date_filter = '2024-01-30'
         query = f"CAPTURE_DATE >= '{fire_date_filter}'"
-        features = feature_layer.query(where=query, return_geometry=True)
+        envelope = query_envelope(active_destinations())
+        if envelope:
+            features = feature_layer.query(where=query, return_geometry=True, geometry_filter=intersects(envelope, sr=4326))
+        else:
+            features = feature_layer.query(where=query, return_geometry=True)
         
         if not features:
-            raise ValueError("No features retrieved from query.")
+            raise NoFeaturesError("No features retrieved from query.")
         
         print(f"Retrieved {len(features)} features")
         
@@ -63,13 +94,18 @@ def fetch_fire_data():
         print(f"Simplified {len(features)} features")
         return features
 
+    except NoFeaturesError as e:
+        print(f"Error: {e}")
+        return []
+
     except Exception as e:
         print(f"Error: {e}")
+        reset_gis_session()
         return []
 
 
 
-def construct_cot_message(features):
+def construct_cot_message(features, tier):
     print("Constructing CoT messages...")
 
     now = datetime.utcnow()
@@ -87,9 +123,6 @@ def construct_cot_message(features):
             # Extract attributes
             uid = attributes["OBJECTID"]
             callsign = attributes.get("FIRE_NUMBE", "Unknown")
-            hae = '9999999.0'
-            ce = '9999999.0'
-            le = '9999999.0'
             time = now.strftime("%Y-%m-%dT%H:%M:%SZ")
             start = now.strftime("%Y-%m-%dT%H:%M:%SZ")
             stale = twenty_four_hours_from_now.strftime("%Y-%m-%dT%H:%M:%SZ")
@@ -140,22 +173,6 @@ def construct_cot_message(features):
             event.set("how", "h-e")
 
                     
-            # Create point element
-            if feature.geometry and 'rings' in feature.geometry:
-
-                   
-                first_point = feature.geometry['rings'][0][0]
-                lon, lat = transformer.transform(first_point[0], first_point[1])
-                point = ET.SubElement(event, "point")
-                point.set("lat", str(lat))
-                point.set("lon", str(lon))
-                point.set("hae", hae)
-                point.set("ce", ce)
-                point.set("le", le)
-            else:
-                print(f"Skipping feature {uid} due to missing geometry data.")
-
-
             # Create detail element
             detail = ET.SubElement(event, "detail")
 
@@ -187,22 +204,15 @@ def construct_cot_message(features):
             remarks = ET.SubElement(detail, "remarks")
             remarks.text = remarks_text
 
-            # Add geometry element for the polygon
+            # Add point and polygon for every part and hole of the perimeter
             if feature.geometry and 'rings' in feature.geometry:
-                
-
-                # Extract and convert polygon coordinates
-                rings = feature.geometry['rings']
-                for ring_index, ring in enumerate(rings):
-                    if ring_index == 0:
-                        # Exterior ring
-                        for coord in ring:
-                            lon, lat = transformer.transform(coord[0], coord[1])
-                            link = ET.SubElement(detail, "link")
-                            link.set("point", f"{lat}, {lon}")
-
-
-            cot_messages.append(event)
+                ring_events = encode_polygon_events(event, feature.geometry['rings'], transformer, tier)
+                if not ring_events:
+                    print(f"Skipping feature {uid}, none of its rings has enough points for a polygon.")
+                cot_messages.extend(ring_events)
+            else:
+                print(f"Skipping feature {uid} due to missing geometry data.")
+                cot_messages.append(event)
 
         except Exception as e:
             print(f"Error processing feature {attributes['OBJECTID']}: {e}")
@@ -221,51 +231,64 @@ def save_cot_messages(cot_messages):
             file.write(cot_message_xml)
         print(f"Saved message to {filename}")
 
-def send_cot_messages(cot_messages):
-    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
-    context.load_cert_chain(certfile=CERT_FILE, keyfile=KEY_FILE)
-
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    ssl_sock = context.wrap_socket(sock, server_hostname=TAK_IP)
-
-    ssl_sock.connect((TAK_IP, TAK_PORT))
-
-    for cot_message in cot_messages:
-        cot_message_xml = ET.tostring(cot_message, encoding='utf-8', method='xml')
-        ssl_sock.sendall(cot_message_xml)
-
-    ssl_sock.close()
-    print("All messages sent successfully")
-
-def main():
-    while True:
-        try:
-            # Fetch and process data
-            features = fetch_fire_data()
-            if not features:
-                print("No features retrieved. Skipping processing.")
-                continue
-
-            cot_messages = construct_cot_message(features)
+def send_cot_messages(cot_messages, on_sent=None, destination=None):
+    host = destination["host"] if destination else TAK_IP
+    port = destination["port"] if destination else TAK_PORT
+    send_tls(cot_messages, on_sent, host, port, CERT_FILE, KEY_FILE)
+
+def send_cot_messages_udp(cot_messages, on_sent=None, destination=None):
+    send_udp(cot_messages, on_sent, UDP_PEERS or [UDP_MULTICAST_GROUP], UDP_MULTICAST_TTL,
+             UDP_MAX_DATAGRAM, UDP_BATCH_XML, UDP_SEND_RATE)
+
+def active_destinations():
+    if OUTPUT_MODE == "udp":
+        return [{"name": "mesh", "aoi": UDP_AOI, "lod_tier": UDP_LOD_TIER}]
+    return DESTINATIONS
+
+def fetch_features():
+    features = fetch_fire_data()
+    if not features:
+        raise NoFeaturesError("No features retrieved from query.")
+    return features
+
+def run_cycle(checkpoint):
+    # Each stage is skipped if the checkpoint already holds its output
+    if "features" not in checkpoint:
+        features = call_upstream(BREAKERS, "portal", fetch_features)
+        checkpoint.update(created=time.time(), stage="fetched", features=[feature.as_dict for feature in features])
+        save_checkpoint(CHECKPOINT_FILE, checkpoint)
+
+    if "messages" not in checkpoint:
+        features = [Feature.from_dict(feature) for feature in checkpoint["features"]]
+        # Each level of detail is built once and shared by the destinations that use it
+        messages = {}
+        for tier in {destination["lod_tier"] for destination in active_destinations()}:
+            cot_messages = construct_cot_message(features, tier)
             if not cot_messages:
-                print("No CoT messages constructed. Skipping sending.")
-                continue
+                raise ValueError("No CoT messages constructed.")
+            messages[tier] = [ET.tostring(m, encoding='unicode') for m in cot_messages]
+        checkpoint.update(stage="built", messages=messages)
+        save_checkpoint(CHECKPOINT_FILE, checkpoint)
+
+    cot_messages = {tier: [ET.fromstring(m) for m in messages] for tier, messages in checkpoint["messages"].items()}
+    if checkpoint["stage"] != "sent":
+        destinations = active_destinations()
+        routes = {}
+        for tier, tier_messages in cot_messages.items():
+            routes.update(route_cot_messages(tier_messages, [d for d in destinations if d["lod_tier"] == tier], AOI_GRID_SIZE))
+        send = send_cot_messages_udp if OUTPUT_MODE == "udp" else send_cot_messages
+        send_to_destinations(checkpoint, destinations, routes, send, BREAKERS)
+        save_checkpoint(CHECKPOINT_FILE, checkpoint)
+
+    # Keep the most detailed tier that was built on disk
+    save_cot_messages(cot_messages[next(tier for tier in LOD_TIERS if tier in cot_messages)])
 
-            send_cot_messages(cot_messages)
-            save_cot_messages(cot_messages)
-            print("Messages sent. Restarting the script in 24 hours...")
-
-            # Calculate time until next run
-            now = datetime.now()
-            next_run = now + timedelta(days=1)
-            next_run = next_run.replace(hour=0, minute=0, second=0, microsecond=0)
-            sleep_time = (next_run - now).total_seconds()
-            time.sleep(sleep_time)
+def main():
+    # Only the protobuf tiers are sized to fit one datagram, anything else would be skipped on the mesh
+    if OUTPUT_MODE == "udp" and LOD_TIERS[UDP_LOD_TIER]["encoding"] != "protobuf":
+        raise ValueError(f"UDP_LOD_TIER '{UDP_LOD_TIER}' is not a protobuf encoded tier")
+    run_cycles(run_cycle, CHECKPOINT_FILE, BREAKERS, active_destinations)
 
-        except Exception as e:
-            print(f"Error in main loop: {e}")
-            print("Restarting the script in 1 hour...")
-            time.sleep(3600)
 
 if __name__ == "__main__":
     main()
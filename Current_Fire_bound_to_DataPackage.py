@@ -1,17 +1,20 @@
+import hashlib
 import json
 import xml.etree.ElementTree as ET
-from arcgis.gis import GIS  # pip install arcgis (https://developers.arcgis.com/python/guide/intro/)
 from datetime import datetime, timedelta
-import socket
-import ssl
 import time
 import os
+import re
 import uuid
 import requests
-from arcgis.geometry import Geometry
-from arcgis.geometry.functions import simplify, generalize
+from arcgis.geometry.filters import intersects
+from arcgis.geometry.functions import generalize
 from pyproj import Transformer
+from cot_geometry import encode_polygon_events
+from cot_routing import parent_uid, query_envelope, route_cot_messages
+from cot_portal import FIRE_ITEM_ID, NoFeaturesError, get_feature_layer, reset_gis_session
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
 import certifi
 
 
@@ -20,24 +23,53 @@ OUTPUT_DIR = r"path\\to\\Fire COT"
 BASE_URL = "https://00.00.000.00:0000/Marti"  # Replace with your actual base URL
 MISSION_UPLOAD_ENDPOINT = "/sync/missioncreate"
 
-ZIP_FILE = os.path.join(OUTPUT_DIR, "cot_files.zip")
-METADATA_FILE = os.path.join(OUTPUT_DIR, "metadata.json")
+# Data package sharding. Events are grouped by SHARD_KEY ("region" uses the forest area
+# letter of the fire number, "fire_prefix" its first SHARD_PREFIX_LENGTH characters, None
+# builds one package), shards over SHARD_MAX_BYTES are split, and only shards whose content
+# changed since the last upload, or whose events would go stale before the next run, are sent
+# again. Each package set is kept in its own directory under PACKAGE_DIR.
+PACKAGE_DIR = os.path.join(OUTPUT_DIR, "packages")
+SHARD_MANIFEST_FILE = os.path.join(PACKAGE_DIR, "shard_manifest.json")
+SHARD_KEY = "region"
+SHARD_PREFIX_LENGTH = 3
+SHARD_MAX_BYTES = 5 * 1024 * 1024  # uncompressed CoT bytes per shard
+SHARD_WORKERS = 4  # shards built in parallel
+SHARD_STALE_AGE = 24 * 60 * 60  # seconds, the stale time construct_cot_message() gives every event
+SHARD_REFRESH_MARGIN = 2 * 60 * 60  # seconds before going stale that an unchanged shard is uploaded again
+
+FOREST_AREAS = {
+    "C": "Calgary",
+    "E": "Edson",
+    "G": "Grande_Prairie",
+    "H": "High_Level",
+    "L": "Lac_La_Biche",
+    "M": "Fort_McMurray",
+    "P": "Peace_River",
+    "R": "Rocky_Mountain_House",
+    "S": "Slave_Lake",
+    "W": "Whitecourt",
+}
 
 CERT_FILE = r"path\\to\\\\user.crt.pem"  # path to your cert
 KEY_FILE = r"path\\to\\user.key.pem"  # path to your key
 
 TAK_IP = "00.00.000.00"  # specify your IP
-TAK_PORT = ####  # specify port
-
+TAK_PORT = 8089  # specify port
 
+# Each server's area of interest as (xmin, ymin, xmax, ymax) in WGS 84, aoi None takes every
+# incident. Servers with the same tier and AOI share one set of packages, and when every server
+# has an AOI the query only asks for features inside their combined envelope.
 SERVERS = [
     {
         "host": "35.83.128.25",
         "port": 8443,
-        "protocol": "https"
+        "protocol": "https",
+        "lod_tier": "full",  # cot_geometry LOD tier packaged for this server
+        "aoi": None
     }
     # Add more servers as needed, sorted appropriately
 ]
+AOI_GRID_SIZE = 0.5  # degrees per cell of the local spatial index
 
 def unescape(s):
     s = s.replace("&lt;", "<")
@@ -45,22 +77,22 @@ def unescape(s):
     s = s.replace("&amp;", "&")
     return s
 
-
-
 def fetch_fire_data():
     try:
         # Connect to the ArcGIS Online account
-        gis = GIS(url="https://geospatial.alberta.ca/portal")
-        item = gis.content.get("0b775584ff2e4e2a8f0689a339614258")
-        feature_layer = item.layers[3]
+        feature_layer = get_feature_layer(FIRE_ITEM_ID, 3)
         
         # Query features and retrieve attributes
         fire_date_filter = '2024-01-30'
         query = f"CAPTURE_DATE >= '{fire_date_filter}'"
-        features = feature_layer.query(where=query, return_geometry=True)
+        envelope = query_envelope(SERVERS)
+        if envelope:
+            features = feature_layer.query(where=query, return_geometry=True, geometry_filter=intersects(envelope, sr=4326))
+        else:
+            features = feature_layer.query(where=query, return_geometry=True)
         
         if not features:
-            raise ValueError("No features retrieved from query.")
+            raise NoFeaturesError("No features retrieved from query.")
         
         print(f"Retrieved {len(features)} features")
         
@@ -82,13 +114,18 @@ def fetch_fire_data():
         print(f"Simplified {len(features)} features")
         return features
 
+    except NoFeaturesError as e:
+        print(f"Error: {e}")
+        return []
+
     except Exception as e:
         print(f"Error: {e}")
+        reset_gis_session()
         return []
 
 
 
-def construct_cot_message(features):
+def construct_cot_message(features, tier):
     print("Constructing CoT messages...")
 
     now = datetime.utcnow()
@@ -106,9 +143,6 @@ def construct_cot_message(features):
             # Extract attributes
             uid = attributes["OBJECTID"]
             callsign = attributes.get("FIRE_NUMBE", "Unknown")
-            hae = '9999999.0'
-            ce = '9999999.0'
-            le = '9999999.0'
             time = now.strftime("%Y-%m-%dT%H:%M:%SZ")
             start = now.strftime("%Y-%m-%dT%H:%M:%SZ")
             stale = twenty_four_hours_from_now.strftime("%Y-%m-%dT%H:%M:%SZ")
@@ -159,22 +193,6 @@ def construct_cot_message(features):
             event.set("how", "h-e")
 
                     
-            # Create point element
-            if feature.geometry and 'rings' in feature.geometry:
-
-                   
-                first_point = feature.geometry['rings'][0][0]
-                lon, lat = transformer.transform(first_point[0], first_point[1])
-                point = ET.SubElement(event, "point")
-                point.set("lat", str(lat))
-                point.set("lon", str(lon))
-                point.set("hae", hae)
-                point.set("ce", ce)
-                point.set("le", le)
-            else:
-                print(f"Skipping feature {uid} due to missing geometry data.")
-
-
             # Create detail element
             detail = ET.SubElement(event, "detail")
 
@@ -206,22 +224,15 @@ def construct_cot_message(features):
             remarks = ET.SubElement(detail, "remarks")
             remarks.text = remarks_text
 
-            # Add geometry element for the polygon
+            # Add point and polygon for every part and hole of the perimeter
             if feature.geometry and 'rings' in feature.geometry:
-                
-
-                # Extract and convert polygon coordinates
-                rings = feature.geometry['rings']
-                for ring_index, ring in enumerate(rings):
-                    if ring_index == 0:
-                        # Exterior ring
-                        for coord in ring:
-                            lon, lat = transformer.transform(coord[0], coord[1])
-                            link = ET.SubElement(detail, "link")
-                            link.set("point", f"{lat}, {lon}")
-
-
-            cot_messages.append(event)
+                ring_events = encode_polygon_events(event, feature.geometry['rings'], transformer, tier)
+                if not ring_events:
+                    print(f"Skipping feature {uid}, none of its rings has enough points for a polygon.")
+                cot_messages.extend(ring_events)
+            else:
+                print(f"Skipping feature {uid} due to missing geometry data.")
+                cot_messages.append(event)
 
         except Exception as e:
             print(f"Error processing feature {attributes['OBJECTID']}: {e}")
@@ -240,53 +251,157 @@ def save_cot_messages(cot_messages):
             file.write(cot_message_xml)
         print(f"Saved message to {filename}")
 
-def upload_file_to_server(server):
+def shard_key(cot_message):
+    # Children of a perimeter share the fire number in their callsign, so they land in the parent's shard
+    contact = cot_message.find("detail/contact")
+    fire_number = (contact.get("callsign") if contact is not None else None) or "Unknown"
+    if SHARD_KEY == "region":
+        return FOREST_AREAS.get(fire_number[:1].upper(), "Other")
+    if SHARD_KEY == "fire_prefix":
+        return fire_number[:SHARD_PREFIX_LENGTH].upper()
+    return "all"
+
+def shard_cot_messages(cot_messages):
+    # Group by shard key, then split any shard over SHARD_MAX_BYTES without separating a perimeter's parts
+    groups = {}
+    for cot_message in cot_messages:
+        key = re.sub(r"[^A-Za-z0-9_-]+", "_", shard_key(cot_message))
+        groups.setdefault(key, {}).setdefault(parent_uid(cot_message), []).append(cot_message)
+
+    shards = {}
+    for key, perimeters in sorted(groups.items()):
+        part = 1
+        size = 0
+        for perimeter_uid in sorted(perimeters):
+            events = perimeters[perimeter_uid]
+            events_size = sum(len(ET.tostring(event, encoding='utf-8', method='xml')) for event in events)
+            name = f"{key}-{part}"
+            if size and size + events_size > SHARD_MAX_BYTES:
+                part += 1
+                size = 0
+                name = f"{key}-{part}"
+            shards.setdefault(name, []).extend(events)
+            size += events_size
+    return shards
+
+def shard_digest(cot_messages):
+    # time/start/stale change every cycle, leave them out so only real content changes trigger an upload
+    digest = hashlib.sha256()
+    for cot_message in cot_messages:
+        for attribute in ("uid", "type", "how"):
+            digest.update(str(cot_message.get(attribute)).encode("utf-8"))
+        for child in cot_message:
+            digest.update(ET.tostring(child, encoding='utf-8', method='xml'))
+    return digest.hexdigest()
+
+def package_sets():
+    # Servers with the same tier and AOI get the same packages, so each set is built once
+    sets = {}
+    for server in SERVERS:
+        name = server["lod_tier"]
+        if server["aoi"] is not None:
+            name = re.sub(r"[^A-Za-z0-9_-]+", "_", f"{name}_{'_'.join(str(c) for c in server['aoi'])}")
+        package_set = sets.setdefault(name, {"name": name, "lod_tier": server["lod_tier"], "aoi": server["aoi"], "servers": []})
+        package_set["servers"].append(server)
+    return list(sets.values())
+
+def server_key(server):
+    # Manifest key, several TAK servers can share a host on different ports
+    return f"{server['host']}:{server['port']}"
+
+def upload_due(entry, digest):
+    # The digest leaves out time/start/stale, so an unchanged shard still goes out again before its events go stale
+    if not isinstance(entry, dict) or entry.get("digest") != digest:
+        return True
+    return time.time() - entry.get("uploaded", 0) > SHARD_STALE_AGE - SHARD_REFRESH_MARGIN
+
+def build_package(package_dir, name, cot_messages, digest):
+    zip_file = os.path.join(package_dir, f"cot_files_{name}.zip")
+    files = [f"{cot_message.get('uid')}.cot" for cot_message in cot_messages]
+
+    metadata = {
+        "metadata_version": "1.0",
+        "description": f"CoT Messages for Fire Data ({name})",
+        "generated_on": datetime.now().isoformat(),
+        "files": files
+    }
+
+    with zipfile.ZipFile(zip_file, 'w', compression=zipfile.ZIP_DEFLATED) as zipf:
+        for filename, cot_message in zip(files, cot_messages):
+            zipf.writestr(filename, ET.tostring(cot_message, encoding='utf-8', method='xml'))
+        zipf.writestr("metadata.json", json.dumps(metadata, indent=4))
+    return {"name": name, "zip_file": zip_file, "digest": digest}
+
+def build_packages(package_set, cot_messages, manifest):
+    package_dir = os.path.join(PACKAGE_DIR, package_set["name"])
+    if not os.path.exists(package_dir):
+        os.makedirs(package_dir)
+
+    # Shards no server in the set needs to upload are not rebuilt; a refresh rebuilds them
+    # so the events carry new time/start/stale
+    servers = package_set["servers"]
+    packages = []
+    to_build = []
+    for name, shard in shard_cot_messages(cot_messages).items():
+        name = f"{package_set['name']}_{name}"
+        digest = shard_digest(shard)
+        zip_file = os.path.join(package_dir, f"cot_files_{name}.zip")
+        if os.path.exists(zip_file) and not any(upload_due(manifest.get(server_key(server), {}).get(name), digest) for server in servers):
+            packages.append({"name": name, "zip_file": zip_file, "digest": digest})
+        else:
+            to_build.append((package_dir, name, shard, digest))
+
+    # zlib releases the GIL, so shards compress in parallel on threads
+    with ThreadPoolExecutor(max_workers=SHARD_WORKERS) as executor:
+        packages.extend(executor.map(lambda item: build_package(*item), to_build))
+
+    print(f"Built {len(to_build)} of {len(packages)} {package_set['name']} data package shards")
+    return packages
+
+def prune_packages(package_set, packages, manifest):
+    # Forget shards that are gone, such as a region with no fires left or a -2 part merged back into -1
+    current = {package["name"] for package in packages}
+    for server in package_set["servers"]:
+        uploaded = manifest.get(server_key(server), {})
+        for name in [name for name in uploaded if name not in current]:
+            print(f"Shard {name} no longer exists, dropping it from the manifest for {server_key(server)}")
+            del uploaded[name]
+
+    package_dir = os.path.join(PACKAGE_DIR, package_set["name"])
+    for filename in os.listdir(package_dir):
+        if filename.startswith("cot_files_") and filename.endswith(".zip") and filename[len("cot_files_"):-len(".zip")] not in current:
+            os.remove(os.path.join(package_dir, filename))
+    save_manifest(manifest)
+
+def load_manifest():
     try:
-        base_url = f"{server['protocol']}://{server['host']}:{server['port']}{MISSION_UPLOAD_ENDPOINT}"
-
-        # Prepare metadata JSON (assuming it's already generated as per previous steps)
-        metadata = {
-            "metadata_version": "1.0",
-            "description": "CoT Messages for Fire Data",
-            "generated_on": datetime.now().isoformat(),
-            "files": []
-        }
-
-        for root, _, files in os.walk(OUTPUT_DIR):
-            for file in files:
-                if file.endswith(".cot") or file == "metadata.json":
-                    metadata["files"].append(file)
-
-        with open(METADATA_FILE, 'w') as f:
-            json.dump(metadata, f, indent=4)
-        print(f"Created metadata file at {METADATA_FILE}")
-
-        # Zip the files
-        with zipfile.ZipFile(ZIP_FILE, 'w') as zipf:
-            for root, _, files in os.walk(OUTPUT_DIR):
-                for file in files:
-                    if file.endswith(".cot") or file == "metadata.json":
-                        zipf.write(os.path.join(root, file), arcname=file)
-        print(f"Zipped CoT files to {ZIP_FILE}")
+        with open(SHARD_MANIFEST_FILE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
 
-        # Upload the ZIP file
-        files = {'file': open(ZIP_FILE, 'rb')}
-        headers = {'Content-Type': 'application/zip'}
+def save_manifest(manifest):
+    with open(SHARD_MANIFEST_FILE, 'w') as f:
+        json.dump(manifest, f, indent=4)
 
-        # Load P12 certificate and key
-        #cert = (CERT_FILE, KEY_FILE)
-        
-        context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
-        context.load_cert_chain(certfile=CERT_FILE, keyfile=KEY_FILE)
+def upload_file_to_server(server, zip_file):
+    base_url = f"{server['protocol']}://{server['host']}:{server['port']}{MISSION_UPLOAD_ENDPOINT}"
+    try:
+        # Upload the ZIP file
+        with open(zip_file, 'rb') as f:
+            files = {'file': f}
+            headers = {'Content-Type': 'application/zip'}
 
-        # Provide P12 certificate for SSL client authentication
-        response = requests.post(base_url, files=files, headers=headers, cert=context, verify=False)
+            # Provide certificate and key for SSL client authentication
+            cert = (CERT_FILE, KEY_FILE)
+            response = requests.post(base_url, files=files, headers=headers, cert=cert, verify=False)
 
         if response.status_code == 200:
             response_data = response.json()
             uploaded_url = response_data.get('url')
             if uploaded_url:
                 print(f"File uploaded successfully to {base_url}. Uploaded URL: {uploaded_url}")
+                return True
             else:
                 print("Failed to retrieve upload URL from server response.")
         else:
@@ -295,12 +410,40 @@ def upload_file_to_server(server):
 
     except requests.exceptions.RequestException as e:
         print(f"Error uploading file to {base_url}: {e}")
+    return False
+
+def upload_changed_packages(server, packages, manifest):
+    # Only shards that changed, or are due a refresh, since the last successful upload to this server are sent
+    uploaded = manifest.setdefault(server_key(server), {})
+    for package in packages:
+        if not upload_due(uploaded.get(package["name"]), package["digest"]):
+            print(f"Shard {package['name']} unchanged on {server_key(server)}, skipping")
+            continue
+        if upload_file_to_server(server, package["zip_file"]):
+            uploaded[package["name"]] = {"digest": package["digest"], "uploaded": time.time()}
+            save_manifest(manifest)
 
 def main():
     try:
-        for server in SERVERS:
-            upload_file_to_server(server)
-            print(f"File upload to {server['host']} completed successfully.")
+        features = fetch_fire_data()
+        if not features:
+            # Don't let a failed query prune every shard
+            raise NoFeaturesError("No features retrieved from query.")
+        manifest = load_manifest()
+
+        # Each level of detail is built once, then routed to every package set that uses it
+        tiers = {}
+        for package_set in package_sets():
+            tier = package_set["lod_tier"]
+            if tier not in tiers:
+                tiers[tier] = construct_cot_message(features, tier)
+            cot_messages = route_cot_messages(tiers[tier], [package_set], AOI_GRID_SIZE)[package_set["name"]]
+            packages = build_packages(package_set, cot_messages, manifest)
+            prune_packages(package_set, packages, manifest)
+
+            for server in package_set["servers"]:
+                upload_changed_packages(server, packages, manifest)
+                print(f"File upload to {server['host']} completed successfully.")
         
         print("All files uploaded to all servers. Restarting the script in 24 hours...")
 
@@ -0,0 +1,201 @@
+import json
+import os
+import random
+import socket
+import ssl
+import time
+import xml.etree.ElementTree as ET
+from datetime import datetime, timedelta
+from cot_mesh import pack_udp_datagrams
+
+# Cycle executor shared by the feeds: TLS and UDP senders, checkpoints and retries.
+# A failed cycle resumes from the last completed stage (fetched, built, sent up to
+# uid) after an exponential backoff, and each upstream gets a circuit breaker so a
+# dead service is not hammered. Each feed keeps its own checkpoint file, breakers
+# and fetch/construct stages and passes them in.
+
+TAK_SEND_TIMEOUT = 60  # seconds a stalled connection may block before the send fails
+TAK_EVENTS_PER_CONNECTION = 500  # events per connection, each is checkpointed once it closes cleanly
+
+CHECKPOINT_MAX_AGE = 6 * 60 * 60  # seconds before an unfinished cycle is started over
+RETRY_BASE_DELAY = 30  # seconds, doubled after every failed attempt
+RETRY_MAX_DELAY = 15 * 60  # seconds
+BREAKER_FAILURE_THRESHOLD = 5  # consecutive failures that open an upstream's breaker
+BREAKER_RESET_TIMEOUT = 10 * 60  # seconds an open breaker waits before a trial call
+
+def send_tls(cot_messages, on_sent, host, port, cert_file, key_file):
+    # Client context that, like Purpose.CLIENT_AUTH before Python 3.10, presents our cert without
+    # verifying the server's; since 3.10 CLIENT_AUTH builds a server context and the handshake hangs
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    context.load_cert_chain(certfile=cert_file, keyfile=key_file)
+
+    # A connection only counts as delivered once it closes cleanly. On any error the checkpoint
+    # keeps the uid from before it opened and the whole batch is resent; TAK replaces events by uid
+    for i in range(0, len(cot_messages), TAK_EVENTS_PER_CONNECTION):
+        batch = cot_messages[i:i + TAK_EVENTS_PER_CONNECTION]
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.settimeout(TAK_SEND_TIMEOUT)
+        ssl_sock = context.wrap_socket(sock, server_hostname=host)
+        try:
+            ssl_sock.connect((host, port))
+
+            for cot_message in batch:
+                cot_message_xml = ET.tostring(cot_message, encoding='utf-8', method='xml')
+                ssl_sock.sendall(cot_message_xml)
+
+            # Half-close and let the server finish reading before closing; a plain close() with unread
+            # TLS session tickets resets the connection and the server drops whatever it hasn't read yet.
+            # A reset here means the server may not have read everything, so it fails the batch
+            ssl_sock.shutdown(socket.SHUT_WR)
+            while ssl_sock.recv(4096):
+                pass
+        finally:
+            ssl_sock.close()
+
+        if on_sent:
+            on_sent(batch[-1].get("uid"))
+    print("All messages sent successfully")
+
+def send_udp(cot_messages, on_sent, targets, ttl, max_datagram, batch_xml, send_rate):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, ttl)
+
+    datagrams = pack_udp_datagrams(cot_messages, max_datagram, batch_xml)
+    for datagram in datagrams:
+        for target in targets:
+            sock.sendto(datagram, target)
+        if send_rate:
+            time.sleep(1.0 / send_rate)
+
+    sock.close()
+    if on_sent and cot_messages:
+        on_sent(cot_messages[-1].get("uid"))
+    print(f"Sent {len(cot_messages)} messages in {len(datagrams)} datagrams to {targets}")
+
+def load_checkpoint(checkpoint_file):
+    try:
+        with open(checkpoint_file) as f:
+            checkpoint = json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+    # Don't resume a cycle whose data is too old to be worth sending
+    if time.time() - checkpoint.get("created", 0) > CHECKPOINT_MAX_AGE:
+        print("Discarding stale checkpoint")
+        return {}
+    return checkpoint
+
+def save_checkpoint(checkpoint_file, checkpoint):
+    if not checkpoint:
+        return
+    checkpoint_dir = os.path.dirname(checkpoint_file)
+    if checkpoint_dir and not os.path.exists(checkpoint_dir):
+        os.makedirs(checkpoint_dir)
+
+    # Write to a temp file first so a crash never leaves a half written checkpoint
+    temp_file = checkpoint_file + ".tmp"
+    with open(temp_file, "w") as f:
+        json.dump(checkpoint, f)
+    os.replace(temp_file, checkpoint_file)
+
+def clear_checkpoint(checkpoint_file):
+    if os.path.exists(checkpoint_file):
+        os.remove(checkpoint_file)
+
+def breaker_wait(breakers, name):
+    # Seconds until an open breaker lets a trial call through, 0 if it's closed
+    breaker = breakers.setdefault(name, {"failures": 0, "opened_at": None})
+    if breaker["opened_at"] is None:
+        return 0
+    return max(0, breaker["opened_at"] + BREAKER_RESET_TIMEOUT - time.time())
+
+def call_upstream(breakers, name, func, *args, **kwargs):
+    wait = breaker_wait(breakers, name)
+    if wait > 0:
+        raise RuntimeError(f"Circuit open for {name}, next attempt in {wait:.0f} seconds")
+
+    breaker = breakers[name]
+    try:
+        result = func(*args, **kwargs)
+    except Exception:
+        breaker["failures"] += 1
+        if breaker["failures"] >= BREAKER_FAILURE_THRESHOLD:
+            breaker["opened_at"] = time.time()
+            print(f"Opened circuit for {name} after {breaker['failures']} failures")
+        raise
+
+    breaker["failures"] = 0
+    breaker["opened_at"] = None
+    return result
+
+def retry_delay(attempt):
+    # Exponential backoff with jitter so retries neither spin nor stall for hours
+    delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt)
+    return delay * random.uniform(0.5, 1.0)
+
+def next_run_delay():
+    # Calculate the time until the next run (next day at midnight)
+    now = datetime.now()
+    next_run = now + timedelta(days=1)
+    next_run = next_run.replace(hour=0, minute=0, second=0, microsecond=0)
+    return (next_run - now).total_seconds()
+
+def send_remaining(checkpoint, destination, cot_messages, send):
+    # Skip everything up to the last uid this destination confirmed on a clean close before a failure
+    sent_uids = checkpoint.setdefault("sent_uids", {})
+    sent_uid = sent_uids.get(destination["name"])
+    uids = [cot_message.get("uid") for cot_message in cot_messages]
+    remaining = cot_messages[uids.index(sent_uid) + 1:] if sent_uid in uids else cot_messages
+    if len(remaining) < len(cot_messages):
+        print(f"Resuming send to {destination['name']} after uid {sent_uid}, {len(remaining)} messages left")
+
+    def on_sent(uid):
+        sent_uids[destination["name"]] = uid
+
+    send(remaining, on_sent, destination)
+    checkpoint.setdefault("done", []).append(destination["name"])
+
+def send_to_destinations(checkpoint, destinations, routes, send, breakers):
+    # A failing destination doesn't hold up the others, it's retried on the next attempt
+    failed = []
+    for destination in destinations:
+        if destination["name"] in checkpoint.get("done", []):
+            continue
+        try:
+            call_upstream(breakers, destination["name"], send_remaining, checkpoint, destination, routes[destination["name"]], send)
+        except Exception as e:
+            print(f"Error sending to {destination['name']}: {e}")
+            failed.append(destination["name"])
+    if failed:
+        raise RuntimeError(f"Sending failed for {', '.join(failed)}")
+    checkpoint["stage"] = "sent"
+
+def run_cycles(run_cycle, checkpoint_file, breakers, active_destinations):
+    # Runs the feed's cycle once a day, resuming a failed cycle from its checkpoint. The
+    # fetch goes through the "portal" breaker, each destination through its own
+    attempt = 0
+    while True:
+        checkpoint = load_checkpoint(checkpoint_file)
+        try:
+            run_cycle(checkpoint)
+            clear_checkpoint(checkpoint_file)
+            attempt = 0
+            print("Messages sent. Restarting the script in 24 hours...")
+            time_to_sleep = next_run_delay()
+
+        except Exception as e:
+            print(f"Error: {e}")
+            save_checkpoint(checkpoint_file, checkpoint)
+            # Wait until an upstream the next stage needs is out of its breaker, never less than the backoff
+            if "messages" in checkpoint:
+                upstreams = [d["name"] for d in active_destinations() if d["name"] not in checkpoint.get("done", [])]
+            else:
+                upstreams = ["portal"]
+            time_to_sleep = max(retry_delay(attempt), min([breaker_wait(breakers, name) for name in upstreams], default=0))
+            attempt += 1
+            print(f"Resuming from stage '{checkpoint.get('stage', 'start')}' in {time_to_sleep:.0f} seconds...")
+
+        # Sleep until the next run, if loaded into nssm this will continue running as a process
+        time.sleep(time_to_sleep)
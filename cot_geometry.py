@@ -0,0 +1,218 @@
+import copy
+import math
+import xml.etree.ElementTree as ET
+from cot_mesh import MESH_MAX_DATAGRAM, cot_to_protobuf
+
+# Perimeter encoding shared by the Current_Fire scripts: splits esri polygon rings into
+# parts and holes and encodes each as a u-d-f event within a level-of-detail budget.
+
+# Level-of-detail tiers for perimeter events. Every ring of a perimeter is
+# encoded as its own event and simplified until it fits the tier's per-event
+# vertex and byte budget; parts and holes smaller than min_area (m^2) are dropped.
+# Bytes are counted in the encoding the event goes out in: XML over TLS and data
+# packages, the TAK protocol protobuf in a single mesh datagram.
+LOD_TIERS = {
+    "full": {"max_vertices": 2000, "max_bytes": 96000, "min_area": 0, "encoding": "xml"},
+    "medium": {"max_vertices": 500, "max_bytes": 24000, "min_area": 10000, "encoding": "xml"},
+    "low": {"max_vertices": 100, "max_bytes": 6000, "min_area": 100000, "encoding": "xml"},
+    "mesh": {"max_vertices": 30, "max_bytes": MESH_MAX_DATAGRAM, "min_area": 1000000, "encoding": "protobuf"},
+}
+COORD_DECIMALS = 6  # ~0.1 m, enough for perimeter vertices
+FIT_BISECT_STEPS = 16  # tolerance bisection steps once a ring first fits its vertex budget
+
+def ring_signed_area(ring):
+    # Shoelace formula: ArcGIS writes exterior rings clockwise (negative area)
+    # and holes counter-clockwise (positive area)
+    area = 0.0
+    for p1, p2 in zip(ring, ring[1:] + ring[:1]):
+        area += p1[0] * p2[1] - p2[0] * p1[1]
+    return area / 2.0
+
+def point_in_ring(x, y, ring):
+    inside = False
+    j = len(ring) - 1
+    for i in range(len(ring)):
+        xi, yi = ring[i][0], ring[i][1]
+        xj, yj = ring[j][0], ring[j][1]
+        if (yi > y) != (yj > y) and x < (xj - xi) * (y - yi) / (yj - yi) + xi:
+            inside = not inside
+        j = i
+    return inside
+
+def group_polygon_parts(rings):
+    # Split an esri rings array into [(exterior, [holes]), ...], largest part first
+    parts = []
+    holes = []
+    for ring in rings:
+        if len(ring) < 4:
+            continue
+        if ring_signed_area(ring) <= 0:
+            parts.append((ring, []))
+        else:
+            holes.append(ring)
+
+    # Counter-clockwise only data did not come from an esri service, treat every ring as a part
+    if not parts:
+        parts = [(ring, []) for ring in holes]
+        holes = []
+
+    parts.sort(key=lambda part: abs(ring_signed_area(part[0])), reverse=True)
+    for hole in holes:
+        for exterior, part_holes in parts:
+            if point_in_ring(hole[0][0], hole[0][1], exterior):
+                part_holes.append(hole)
+                break
+        else:
+            parts[0][1].append(hole)
+    return parts
+
+def simplify_ring(ring, tolerance):
+    # Iterative Douglas-Peucker on a closed ring, returns None if the ring collapses
+    keep = [False] * len(ring)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(ring) - 1)]
+    while stack:
+        start, end = stack.pop()
+        x1, y1 = ring[start][0], ring[start][1]
+        x2, y2 = ring[end][0], ring[end][1]
+        dx, dy = x2 - x1, y2 - y1
+        seg_len = math.hypot(dx, dy)
+        max_dist, index = 0.0, None
+        for i in range(start + 1, end):
+            px, py = ring[i][0], ring[i][1]
+            if seg_len == 0:
+                dist = math.hypot(px - x1, py - y1)
+            else:
+                dist = abs(dy * px - dx * py + x2 * y1 - y2 * x1) / seg_len
+            if dist > max_dist:
+                max_dist, index = dist, i
+        if index is not None and max_dist > tolerance:
+            keep[index] = True
+            stack.append((start, index))
+            stack.append((index, end))
+
+    simplified = [p for p, k in zip(ring, keep) if k]
+    if len(simplified) < 4:
+        return None
+    return simplified
+
+def fit_ring_to_budget(ring, max_vertices):
+    if len(ring) <= max_vertices:
+        return ring
+
+    xs = [p[0] for p in ring]
+    ys = [p[1] for p in ring]
+    tolerance = max(max(xs) - min(xs), max(ys) - min(ys)) / 100000.0
+
+    # Raise the tolerance until the ring fits or collapses; low is the last tolerance that
+    # still left too many vertices, high the first that didn't
+    low = 0.0
+    high = None
+    best = None
+    coarsest = ring
+    while tolerance > 0:
+        simplified = simplify_ring(ring, tolerance)
+        if simplified is None:
+            high = tolerance
+            break
+        if len(simplified) <= max_vertices:
+            high = tolerance
+            best = simplified
+            break
+        low = tolerance
+        coarsest = simplified
+        tolerance *= 1.5
+
+    # A single step can drop from far over to far under the budget, so bisect
+    # between low and high for the finest shape that still fits
+    if high is not None:
+        for _ in range(FIT_BISECT_STEPS):
+            mid = (low + high) / 2
+            simplified = simplify_ring(ring, mid)
+            if simplified is None:
+                high = mid
+            elif len(simplified) <= max_vertices:
+                high = mid
+                best = simplified
+            else:
+                low = mid
+                coarsest = simplified
+        if best is not None:
+            return best
+
+    # Degenerate input, fall back to evenly spaced vertices
+    step = math.ceil(len(coarsest) / (max_vertices - 1))
+    return coarsest[:-1:step] + [coarsest[-1]]
+
+def build_ring_event(template, uid, ring, transformer, parent_uid=None, label=None, hole=False):
+    event = copy.deepcopy(template)
+    event.set("uid", uid)
+
+    lons, lats = transformer.transform([p[0] for p in ring], [p[1] for p in ring])
+
+    point = ET.Element("point")
+    point.set("lat", f"{lats[0]:.{COORD_DECIMALS}f}")
+    point.set("lon", f"{lons[0]:.{COORD_DECIMALS}f}")
+    point.set("hae", '9999999.0')
+    point.set("ce", '9999999.0')
+    point.set("le", '9999999.0')
+    event.insert(0, point)
+
+    detail = event.find("detail")
+    if label:
+        contact = detail.find("contact")
+        contact.set("callsign", f"{contact.get('callsign')} ({label})")
+    if hole:
+        # TAK shapes can't cut holes, draw unburned islands as a dashed outline
+        detail.find("fillColor").set("value", "0")
+        detail.find("strokeStyle").set("value", "dashed")
+    if parent_uid:
+        link = ET.SubElement(detail, "link")
+        link.set("uid", parent_uid)
+        link.set("type", "u-d-f")
+        link.set("relation", "p-p")
+
+    for lat, lon in zip(lats, lons):
+        link = ET.SubElement(detail, "link")
+        link.set("point", f"{lat:.{COORD_DECIMALS}f}, {lon:.{COORD_DECIMALS}f}")
+    return event
+
+def encode_ring(template, uid, ring, transformer, tier, **kwargs):
+    # Simplify to the vertex budget, then tighten further until the event fits the byte budget
+    budget = tier["max_vertices"]
+    while True:
+        event = build_ring_event(template, uid, fit_ring_to_budget(ring, budget), transformer, **kwargs)
+        if tier["encoding"] == "protobuf":
+            size = len(cot_to_protobuf(event))
+        else:
+            size = len(ET.tostring(event, encoding='utf-8', method='xml'))
+        if size <= tier["max_bytes"] or budget <= 4:
+            return event
+        budget = max(4, min(budget - 1, int(budget * tier["max_bytes"] / size * 0.9)))
+
+def encode_polygon_events(template, rings, transformer, tier_name):
+    # Encode every part and hole of a perimeter; the largest part keeps the feature uid
+    # and the rest become child events linked back to it
+    tier = LOD_TIERS[tier_name]
+    parent_uid = template.get("uid")
+    events = []
+    part_count = 0
+    hole_count = 0
+
+    for part_index, (exterior, holes) in enumerate(group_polygon_parts(rings)):
+        if part_index == 0:
+            events.append(encode_ring(template, parent_uid, exterior, transformer, tier))
+        else:
+            if abs(ring_signed_area(exterior)) < tier["min_area"]:
+                continue
+            part_count += 1
+            events.append(encode_ring(template, f"{parent_uid}.part{part_count}", exterior, transformer, tier,
+                                      parent_uid=parent_uid, label=f"part {part_count + 1}"))
+
+        for hole in holes:
+            if abs(ring_signed_area(hole)) < tier["min_area"]:
+                continue
+            hole_count += 1
+            events.append(encode_ring(template, f"{parent_uid}.hole{hole_count}", hole, transformer, tier,
+                                      parent_uid=parent_uid, label=f"hole {hole_count}", hole=True))
+    return events
@@ -0,0 +1,82 @@
+import struct
+import xml.etree.ElementTree as ET
+from datetime import datetime, timezone
+
+# TAK protocol v1 mesh encoding shared by the UDP outputs: a minimal protobuf writer
+# for the TakMessage, and packing of events into datagrams that fit the MTU.
+
+MESH_MAX_DATAGRAM = 1400  # bytes, stays below a 1500 byte MTU after IP/UDP headers
+
+def encode_varint(value):
+    out = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+def encode_field(number, value):
+    # Minimal protobuf writer for the TAK protocol messages below
+    if isinstance(value, float):
+        return encode_varint(number << 3 | 1) + struct.pack("<d", value)
+    if isinstance(value, int):
+        return encode_varint(number << 3) + encode_varint(value)
+    if isinstance(value, str):
+        value = value.encode("utf-8")
+    return encode_varint(number << 3 | 2) + encode_varint(len(value)) + value
+
+def cot_time_ms(value):
+    return int(datetime.strptime(value, "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=timezone.utc).timestamp() * 1000)
+
+def cot_to_protobuf(cot_message):
+    # TAK protocol v1 mesh payload: magic header followed by a TakMessage { cotEvent = 2 }
+    point = cot_message.find("point")
+    detail = cot_message.find("detail")
+    xml_detail = b"".join(ET.tostring(child, encoding='utf-8', method='xml') for child in detail) if detail is not None else b""
+
+    cot_event = b"".join([
+        encode_field(1, cot_message.get("type")),
+        encode_field(5, cot_message.get("uid")),
+        encode_field(6, cot_time_ms(cot_message.get("time"))),
+        encode_field(7, cot_time_ms(cot_message.get("start"))),
+        encode_field(8, cot_time_ms(cot_message.get("stale"))),
+        encode_field(9, cot_message.get("how")),
+        encode_field(10, float(point.get("lat")) if point is not None else 0.0),
+        encode_field(11, float(point.get("lon")) if point is not None else 0.0),
+        encode_field(12, float(point.get("hae")) if point is not None else 9999999.0),
+        encode_field(13, float(point.get("ce")) if point is not None else 9999999.0),
+        encode_field(14, float(point.get("le")) if point is not None else 9999999.0),
+        encode_field(15, encode_field(1, xml_detail)),
+    ])
+    return b"\xbf\x01\xbf" + encode_field(2, cot_event)
+
+def pack_udp_datagrams(cot_messages, max_datagram=MESH_MAX_DATAGRAM, batch_xml=False):
+    # One XML event per datagram, or several when batch_xml is set; events too big
+    # for one datagram go out as protobuf, or are skipped if that doesn't fit either
+    datagrams = []
+    batch = b""
+    for cot_message in cot_messages:
+        cot_message_xml = ET.tostring(cot_message, encoding='utf-8', method='xml')
+        if len(cot_message_xml) > max_datagram:
+            payload = cot_to_protobuf(cot_message)
+            if len(payload) > max_datagram:
+                print(f"Skipping event {cot_message.get('uid')}: {len(payload)} bytes as protobuf, "
+                      f"over the {max_datagram} byte datagram limit")
+                continue
+            # Flush the pending batch first so events go out in order
+            if batch:
+                datagrams.append(batch)
+                batch = b""
+            datagrams.append(payload)
+        elif batch_xml and len(batch) + len(cot_message_xml) <= max_datagram:
+            batch += cot_message_xml
+        else:
+            if batch:
+                datagrams.append(batch)
+            batch = cot_message_xml
+    if batch:
+        datagrams.append(batch)
+    return datagrams
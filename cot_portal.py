@@ -0,0 +1,42 @@
+import time
+from arcgis.gis import GIS  # pip install arcgis (https://developers.arcgis.com/python/guide/intro/)
+
+# Alberta portal session shared by the portal feeds. The connection and the item and
+# layer metadata are cached for GIS_CACHE_TTL and dropped after a failed lookup.
+
+PORTAL_URL = "https://geospatial.alberta.ca/portal"
+FIRE_ITEM_ID = "0b775584ff2e4e2a8f0689a339614258"
+GIS_CACHE_TTL = 6 * 60 * 60  # seconds before the portal connection and layer metadata are refreshed
+
+GIS_SESSION = {"gis": None, "created": 0, "items": {}, "layers": {}}
+
+
+class NoFeaturesError(Exception):
+    # A query that returned nothing; not a connection problem, so the session is kept
+    pass
+
+
+def get_gis():
+    # Reuse one portal connection; its HTTP session pools connections across cycles and layers
+    if GIS_SESSION["gis"] is None or time.time() - GIS_SESSION["created"] > GIS_CACHE_TTL:
+        GIS_SESSION.update(gis=GIS(url=PORTAL_URL), created=time.time(), items={}, layers={})
+    return GIS_SESSION["gis"]
+
+def get_feature_layer(item_id, layer_index):
+    # Item and layer metadata are fetched once per session and reused by later cycles. The session
+    # lives in this process, so each feed script still does its own login and item lookup
+    gis = get_gis()
+    key = (item_id, layer_index)
+    if key not in GIS_SESSION["layers"]:
+        if item_id not in GIS_SESSION["items"]:
+            item = gis.content.get(item_id)
+            if item is None:
+                # Missing or not shared with this login; don't cache it so the next cycle looks again
+                raise RuntimeError(f"Portal item {item_id} not found")
+            GIS_SESSION["items"][item_id] = item
+        GIS_SESSION["layers"][key] = GIS_SESSION["items"][item_id].layers[layer_index]
+    return GIS_SESSION["layers"][key]
+
+def reset_gis_session():
+    # Drop the cached connection so the next cycle logs in again
+    GIS_SESSION["gis"] = None
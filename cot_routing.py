@@ -0,0 +1,106 @@
+import math
+
+# Area of interest routing shared by the feeds. AOIs are (xmin, ymin, xmax, ymax) in
+# WGS 84, None receives every incident. Events are matched on their bounding box
+# through a grid index, and a perimeter's parts and holes travel with their parent.
+
+def query_envelope(destinations):
+    # Combined envelope of every AOI for the server side filter, None if any destination wants everything
+    aois = [destination["aoi"] for destination in destinations]
+    if not aois or None in aois:
+        return None
+    return {
+        "xmin": min(aoi[0] for aoi in aois),
+        "ymin": min(aoi[1] for aoi in aois),
+        "xmax": max(aoi[2] for aoi in aois),
+        "ymax": max(aoi[3] for aoi in aois),
+        "spatialReference": {"wkid": 4326},
+    }
+
+def event_bbox(cot_message):
+    # Bounding box of the event point and any polygon vertices, None without a usable location
+    coords = []
+    point = cot_message.find("point")
+    if point is not None:
+        coords.append((point.get("lat"), point.get("lon")))
+    for link in cot_message.iter("link"):
+        if link.get("point"):
+            coords.append(tuple(link.get("point").split(",")))
+
+    lats = []
+    lons = []
+    for lat, lon in coords:
+        try:
+            lats.append(float(lat))
+            lons.append(float(lon))
+        except (TypeError, ValueError):
+            continue
+    if not lats:
+        return None
+    return (min(lons), min(lats), max(lons), max(lats))
+
+def parent_uid(cot_message):
+    # Parts and holes link back to the perimeter they belong to, anything else is its own parent
+    for link in cot_message.iter("link"):
+        if link.get("relation") == "p-p" and link.get("uid"):
+            return link.get("uid")
+    return cot_message.get("uid")
+
+def bbox_union(bboxes):
+    bboxes = [bbox for bbox in bboxes if bbox is not None]
+    if not bboxes:
+        return None
+    return (min(b[0] for b in bboxes), min(b[1] for b in bboxes),
+            max(b[2] for b in bboxes), max(b[3] for b in bboxes))
+
+def bbox_intersects(a, b):
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+def grid_range(bbox, grid_size):
+    return (math.floor(bbox[0] / grid_size), math.floor(bbox[1] / grid_size),
+            math.floor(bbox[2] / grid_size), math.floor(bbox[3] / grid_size))
+
+def build_grid_index(bboxes, grid_size):
+    # Map each grid cell to the entries whose bounding box touches it
+    index = {}
+    for n, bbox in enumerate(bboxes):
+        if bbox is None:
+            continue
+        x0, y0, x1, y1 = grid_range(bbox, grid_size)
+        for i in range(x0, x1 + 1):
+            for j in range(y0, y1 + 1):
+                index.setdefault((i, j), []).append(n)
+    return index
+
+def route_cot_messages(cot_messages, destinations, grid_size):
+    # Route each perimeter, with all of its parts and holes, only to the destinations whose
+    # AOI the union of their bounding boxes intersects
+    groups = {}
+    for n, cot_message in enumerate(cot_messages):
+        groups.setdefault(parent_uid(cot_message), []).append(n)
+    members = list(groups.values())
+    bboxes = [bbox_union(event_bbox(cot_messages[n]) for n in group) for group in members]
+    index = build_grid_index(bboxes, grid_size)
+
+    routes = {}
+    for destination in destinations:
+        aoi = destination["aoi"]
+        if aoi is None:
+            routes[destination["name"]] = cot_messages
+            continue
+
+        # Walk whichever is smaller, the cells under the AOI or the occupied cells
+        x0, y0, x1, y1 = grid_range(aoi, grid_size)
+        if (x1 - x0 + 1) * (y1 - y0 + 1) > len(index):
+            cells = [cell for cell in index if x0 <= cell[0] <= x1 and y0 <= cell[1] <= y1]
+        else:
+            cells = [(i, j) for i in range(x0, x1 + 1) for j in range(y0, y1 + 1)]
+
+        matches = set()
+        for cell in cells:
+            for g in index.get(cell, []):
+                if bbox_intersects(bboxes[g], aoi):
+                    matches.update(members[g])
+        routes[destination["name"]] = [cot_messages[n] for n in sorted(matches)]
+        print(f"Routing {len(matches)} of {len(cot_messages)} messages to {destination['name']}")
+    return routes
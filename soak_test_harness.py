@@ -0,0 +1,535 @@
+import gc
+import importlib.util
+import json
+import math
+import os
+import random
+import re
+import socket
+import ssl
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import urllib.request
+from collections import Counter
+from contextlib import redirect_stdout
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+import cot_cycle
+
+# Soak / load harness: runs real feed loops against a local mock FeatureServer and a
+# mock TLS TAK listener, with the feed's sleeps compressed so thousands of daily
+# cycles run in minutes. Exits non-zero if memory or CPU per unit of work grows over the run,
+# or if any event the feed marked as sent never reached the listener.
+
+FEED_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Feeds soaked in turn. "frames" is the synthetic data the mock query answers with,
+# "replay_file" a JSON list of recorded query responses to serve instead.
+FEEDS = [
+    {"script": "ArcGIS_Sever_toCOT.py", "frames": "incidents", "replay_file": None},
+    {"script": "Current_Fire_bound_to_COT.py", "frames": "perimeters", "replay_file": None},
+]
+
+CYCLES = 2000  # feed loop iterations (successful cycles and retries) to run per feed
+SPEEDUP = 86400.0  # N x real time, a 24 hour sleep takes one second at 86400
+MAX_REAL_SLEEP = 0.05  # seconds, cap so compressed cycles don't idle at all
+
+REPLAY_INTERVAL = 24 * 60 * 60  # virtual seconds each recorded response stays current
+SYNTHETIC_FEATURES = 100  # incidents per synthetic frame
+SYNTHETIC_PERIMETERS = 10  # fire perimeters per synthetic frame
+PERIMETER_VERTICES = (50, 1000)  # vertex range of a synthetic perimeter's outer ring
+SYNTHETIC_TURNOVER = 0.1  # share of incidents replaced every frame
+
+FEATURE_SERVER_FAULT_RATE = 0.02  # share of queries answered with HTTP 503
+TAK_DROP_RATE = 0.02  # share of TAK connections cut mid stream
+
+STALL_TIMEOUT = 60  # real seconds without a finished cycle before the feed counts as stalled
+SAMPLE_EVERY = 20  # cycles between resource samples
+MIN_QUARTER_SAMPLES = 10  # samples each quarter of the run needs for the growth checks
+RSS_GROWTH_LIMIT_MB = 20.0  # allowed RSS growth between the second and last quarter of the run
+CPU_GROWTH_LIMIT = 1.5  # allowed ratio of feed CPU per input vertex between the second and last quarter
+
+
+class StopSoak(BaseException):
+    # BaseException so the feed's own "except Exception" retry handling can't swallow it
+    pass
+
+
+class AcceleratedClock:
+    # Stands in for the feed's time module: sleeps are compressed and the skipped
+    # time is added to time(), so checkpoints and circuit breakers still age correctly
+    def __init__(self, cycles):
+        self.offset = 0.0
+        self.cycles = cycles
+        self.cycle = 0
+        self.on_cycle = None
+
+    def time(self):
+        return time.time() + self.offset
+
+    def sleep(self, seconds):
+        real = min(seconds / SPEEDUP, MAX_REAL_SLEEP)
+        time.sleep(real)
+        self.offset += seconds - real
+
+        # The feed loop only sleeps long between cycles, short sleeps are UDP rate limiting
+        if seconds >= 1:
+            self.cycle += 1
+            if self.on_cycle:
+                self.on_cycle(self.cycle)
+            if self.cycle >= self.cycles:
+                raise StopSoak()
+
+
+def synthetic_frame(frame):
+    # Deterministic per frame so a failed run can be replayed exactly
+    rng = random.Random(frame)
+    first_id = int(frame * SYNTHETIC_FEATURES * SYNTHETIC_TURNOVER)
+    features = []
+    for uid in range(first_id, first_id + SYNTHETIC_FEATURES):
+        home = random.Random(uid)
+        lat = home.uniform(-38.0, -26.0) + rng.uniform(-0.01, 0.01)
+        lon = home.uniform(129.0, 141.0) + rng.uniform(-0.01, 0.01)
+        features.append({
+            "attributes": {
+                "id": uid,
+                "incident_name": f"INC-{uid}",
+                "name": home.choice(["Grass Fire", "Scrub Fire", "Structure Fire", "Vehicle Fire", "Burn Off"]),
+                "first_report": f"{frame:05d} {uid % 24:02d}:00",
+                "status": rng.choice(["Going", "Contained", "Controlled", "Safe"]),
+                "region": f"Region {uid % 6 + 1}",
+                "aircraft": rng.randint(0, 4),
+                "icon": home.choice(["Fire", "Burn", "Structure", "Vehicle", "Hazmat"]),
+                "event": "Fire",
+                "lat": lat,
+                "long": lon,
+            },
+            "geometry": {"x": lon, "y": lat},
+        })
+    return {"features": features}
+
+
+def perimeter_ring(rng, cx, cy, radius, vertices, hole=False):
+    # Noisy circle, clockwise like an esri exterior ring, counter-clockwise for a hole
+    direction = 1 if hole else -1
+    ring = []
+    for n in range(vertices):
+        angle = direction * 2 * math.pi * n / vertices
+        r = radius * rng.uniform(0.9, 1.1)
+        ring.append([round(cx + r * math.cos(angle), 1), round(cy + r * math.sin(angle), 1)])
+    return ring + [ring[0]]
+
+
+def synthetic_perimeter_frame(frame):
+    # Perimeters in EPSG:3400 (Alberta 10-TM) metres, some with a hole or a second part
+    rng = random.Random(frame)
+    first_id = int(frame * SYNTHETIC_PERIMETERS * SYNTHETIC_TURNOVER)
+    features = []
+    for uid in range(first_id, first_id + SYNTHETIC_PERIMETERS):
+        home = random.Random(uid)
+        cx = home.uniform(300000.0, 700000.0)
+        cy = home.uniform(5500000.0, 6600000.0)
+        radius = home.uniform(500.0, 5000.0) * rng.uniform(1.0, 1.05)
+        rings = [perimeter_ring(rng, cx, cy, radius, home.randint(*PERIMETER_VERTICES))]
+        if home.random() < 0.3:
+            rings.append(perimeter_ring(rng, cx, cy, radius * 0.3, 60, hole=True))
+        if home.random() < 0.2:
+            rings.append(perimeter_ring(rng, cx + radius * 3, cy, radius * 0.5, 200))
+        fire_number = f"{home.choice('CEGHLMPRSW')}WF{uid:03d}"
+        features.append({
+            "attributes": {
+                "OBJECTID": uid,
+                "FIRE_NUMBE": fire_number,
+                "FIRENUMBER": fire_number,
+                "FIRE_CLASS": home.choice(["A", "B", "C", "D", "E"]),
+                "BURNCODE": rng.choice(["B", "PB", "I"]),
+                "BURN_CLASS": "Wildfire",
+                "HECTARES_UTM": round(math.pi * radius * radius / 10000.0, 1),
+                "YEAR": 2024,
+                "ALIAS": f"Fire {uid}",
+                "CAPTURE_DATE": f"{frame:05d}",
+                "TIME": f"{uid % 24:02d}:00",
+                "SOURCE": "Synthetic",
+            },
+            "geometry": {"rings": rings, "spatialReference": {"wkid": 3400}},
+        })
+    return {"features": features}
+
+
+SYNTHETIC_FRAMES = {"incidents": synthetic_frame, "perimeters": synthetic_perimeter_frame}
+
+
+def frame_vertices(frame):
+    # Work a query response hands the feed: one per point feature, every ring vertex of a polygon
+    count = 0
+    for feature in frame.get("features", []):
+        geometry = feature.get("geometry") or {}
+        count += sum(len(ring) for ring in geometry.get("rings", [])) or 1
+    return count
+
+
+class MockFeatureServer:
+    def __init__(self, clock, frames, replay_file=None):
+        self.clock = clock
+        self.start = clock.time()
+        self.synthetic_frame = SYNTHETIC_FRAMES[frames]
+        self.frames = None
+        if replay_file:
+            with open(replay_file) as f:
+                self.frames = json.load(f)
+        self.queries = 0
+        self.faults = 0
+        self.vertices = 0
+        self.last_served = None
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if not urlparse(self.path).path.endswith("/query"):
+                    self.send_error(404)
+                    return
+                server.queries += 1
+                if random.random() < FEATURE_SERVER_FAULT_RATE:
+                    server.faults += 1
+                    self.send_error(503)
+                    return
+
+                frame = server.current_frame()
+                body = json.dumps(frame).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                server.last_served = time.perf_counter()
+                server.vertices += frame_vertices(frame)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}/FeatureServer/0/query"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def current_frame(self):
+        # Replay advances with the accelerated clock, not with the number of queries
+        frame = int((self.clock.time() - self.start) / REPLAY_INTERVAL)
+        if self.frames:
+            return self.frames[frame % len(self.frames)]
+        return self.synthetic_frame(frame)
+
+    def close(self):
+        self.httpd.shutdown()
+
+
+class MockTakServer:
+    def __init__(self, cert_file, key_file, feature_server):
+        self.feature_server = feature_server
+        self.context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        self.context.load_cert_chain(certfile=cert_file, keyfile=key_file)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen(16)
+        self.port = self.sock.getsockname()[1]
+
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.dropped = 0
+        self.events = 0
+        self.received = Counter()
+        self.latencies = []
+        self.first_event = None
+        self.last_event = None
+        self.running = True
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    def serve(self):
+        while self.running:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
+
+    def handle(self, conn):
+        with self.lock:
+            self.connections += 1
+        drop_after = random.randint(1, 4096) if random.random() < TAK_DROP_RATE else None
+        received = 0
+        buffer = b""
+        try:
+            ssl_conn = self.context.wrap_socket(conn, server_side=True)
+            while True:
+                data = ssl_conn.recv(65536)
+                if not data:
+                    break
+                received += len(data)
+                buffer += data
+                now = time.perf_counter()
+                if b"</event>" in buffer:
+                    end = buffer.rindex(b"</event>") + len(b"</event>")
+                    self.record(buffer[:end], now)
+                    buffer = buffer[end:]
+                if drop_after is not None and received >= drop_after:
+                    with self.lock:
+                        self.dropped += 1
+                    break
+        except (OSError, ssl.SSLError):
+            with self.lock:
+                self.dropped += 1
+        finally:
+            conn.close()
+
+    def record(self, events, now):
+        # Latency is measured end to end, from the FeatureServer answering the query to ingest
+        count = events.count(b"</event>")
+        uids = re.findall(rb'<event\b[^>]*?\suid="([^"]*)"', events)
+        with self.lock:
+            self.events += count
+            self.received.update(uid.decode("utf-8") for uid in uids)
+            if self.first_event is None:
+                self.first_event = now
+            self.last_event = now
+            if self.feature_server.last_served is not None:
+                self.latencies.extend([now - self.feature_server.last_served] * count)
+                del self.latencies[:-100000]
+
+    def reset_received(self):
+        with self.lock:
+            self.received.clear()
+
+    def take(self, uid):
+        # True if uid arrived since the last reset and hasn't been matched to a sent event yet
+        with self.lock:
+            if self.received[uid] <= 0:
+                return False
+            self.received[uid] -= 1
+            return True
+
+    def close(self):
+        self.running = False
+        self.sock.close()
+
+
+class MockFeatureLayer:
+    # Stands in for the portal layer get_feature_layer() returns, answering query() from the mock FeatureServer
+    def __init__(self, url, feature_class):
+        self.url = url
+        self.feature_class = feature_class
+
+    def query(self, where="1=1", return_geometry=True, **kwargs):
+        params = urllib.parse.urlencode({"f": "json", "where": where, "outFields": "*", "returnGeometry": return_geometry})
+        with urllib.request.urlopen(f"{self.url}?{params}", timeout=60) as response:
+            data = json.load(response)
+        return [self.feature_class.from_dict(feature) for feature in data["features"]]
+
+
+def generate_certificate(directory):
+    cert_file = os.path.join(directory, "soak.crt.pem")
+    key_file = os.path.join(directory, "soak.key.pem")
+    subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-keyout", key_file,
+                    "-out", cert_file, "-days", "1", "-subj", "/CN=localhost"],
+                   check=True, capture_output=True)
+    return cert_file, key_file
+
+
+def rss_mb():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    # Peak rather than current RSS off Linux, still catches steady growth
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024.0 * 1024.0) if sys.platform == "darwin" else peak / 1024.0
+
+
+def load_feed(script, work_dir, cert_file, key_file, feature_server, tak_server, clock):
+    spec = importlib.util.spec_from_file_location("soak_feed", os.path.join(FEED_DIR, script))
+    feed = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(feed)
+
+    # The shared executor's sleeps and clock drive the cycle, checkpoints and circuit breakers too
+    feed.time = clock
+    cot_cycle.time = clock
+    if hasattr(feed, "FEATURE_SERVICE_URL"):
+        feed.FEATURE_SERVICE_URL = feature_server.url
+    if hasattr(feed, "get_feature_layer"):
+        # Portal feeds query the mock FeatureServer through a stub layer; generalize() is a
+        # portal geometry service call, the synthetic perimeters go through as they are
+        layer = MockFeatureLayer(feature_server.url, feed.Feature)
+        feed.get_feature_layer = lambda item_id, layer_index: layer
+        feed.generalize = lambda geometries, **kwargs: geometries
+    feed.OUTPUT_DIR = work_dir
+    feed.CHECKPOINT_FILE = os.path.join(work_dir, "cycle_checkpoint.json")
+    feed.CERT_FILE = cert_file
+    feed.KEY_FILE = key_file
+    feed.OUTPUT_MODE = "tls"
+    feed.TAK_IP = "127.0.0.1"
+    feed.TAK_PORT = tak_server.port
+    feed.DESTINATIONS = [dict(feed.DESTINATIONS[0], host="127.0.0.1", port=tak_server.port)]
+
+    # Every event the feed marks as sent, i.e. every event up to the last uid passed to on_sent,
+    # must have reached the listener by the time the send returns or fails
+    feed.events_sent = 0
+    feed.missing_uids = []
+    send = feed.send_cot_messages
+
+    def checked_send(cot_messages, on_sent=None, destination=None):
+        # What a failed earlier attempt got through doesn't count for this one
+        tak_server.reset_received()
+        marked = []
+
+        def mark(uid):
+            marked.append(uid)
+            if on_sent:
+                on_sent(uid)
+
+        try:
+            send(cot_messages, mark, destination)
+        finally:
+            uids = [cot_message.get("uid") for cot_message in cot_messages]
+            for uid in uids[:uids.index(marked[-1]) + 1] if marked else []:
+                feed.events_sent += 1
+                if not tak_server.take(uid):
+                    feed.missing_uids.append(uid)
+
+    feed.send_cot_messages = checked_send
+    return feed
+
+
+def growth_report(samples):
+    # Compare the second quarter (after warm up) with the last quarter of the run. Frames differ
+    # in size and turn over, so CPU is compared per input vertex rather than per cycle
+    quarter = len(samples) // 4
+    if quarter < MIN_QUARTER_SAMPLES:
+        return None
+    early = samples[quarter:2 * quarter]
+    late = samples[-quarter:]
+
+    rss_growth = statistics.median(s["rss"] for s in late) - statistics.median(s["rss"] for s in early)
+    early_cpu = (early[-1]["cpu"] - early[0]["cpu"]) / max(1, early[-1]["vertices"] - early[0]["vertices"])
+    late_cpu = (late[-1]["cpu"] - late[0]["cpu"]) / max(1, late[-1]["vertices"] - late[0]["vertices"])
+    cpu_ratio = late_cpu / early_cpu if early_cpu > 0 else 1.0
+    return rss_growth, early_cpu, late_cpu, cpu_ratio
+
+
+def soak(feed_config):
+    # Runs one feed for CYCLES cycles and returns the list of failed checks
+    script = feed_config["script"]
+    if CYCLES // SAMPLE_EVERY // 4 < MIN_QUARTER_SAMPLES:
+        print(f"Not soaking {script}: {CYCLES} cycles leave too few samples for the growth checks")
+        return [f"raise CYCLES to at least {SAMPLE_EVERY * 4 * MIN_QUARTER_SAMPLES}"]
+    work_dir = tempfile.mkdtemp(prefix="soak_")
+    cert_file, key_file = generate_certificate(work_dir)
+
+    clock = AcceleratedClock(CYCLES)
+    feature_server = MockFeatureServer(clock, feed_config["frames"], feed_config["replay_file"])
+    tak_server = MockTakServer(cert_file, key_file, feature_server)
+    feed = load_feed(script, work_dir, cert_file, key_file, feature_server, tak_server, clock)
+
+    samples = []
+
+    def on_cycle(cycle):
+        if cycle % SAMPLE_EVERY == 0:
+            gc.collect()
+            # The clock sleeps on the feed thread, so thread_time() leaves out the mock servers
+            samples.append({"cycle": cycle, "rss": rss_mb(), "cpu": time.thread_time(), "vertices": feature_server.vertices})
+        if cycle % (SAMPLE_EVERY * 10) == 0:
+            print(f"cycle {cycle}/{CYCLES}: rss {samples[-1]['rss']:.1f} MB, {tak_server.events} events ingested",
+                  file=sys.__stdout__, flush=True)
+
+    clock.on_cycle = on_cycle
+
+    errors = []
+
+    def run_feed():
+        # The feeds print every message, keep that out of the report
+        try:
+            with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+                feed.main()
+        except StopSoak:
+            pass
+        except BaseException as e:
+            errors.append(e)
+
+    print(f"Soaking {script} for {CYCLES} cycles at {SPEEDUP:.0f}x")
+    started = time.perf_counter()
+    feed_thread = threading.Thread(target=run_feed, daemon=True)
+    feed_thread.start()
+
+    # Watchdog: a send or fetch that never returns shows up as a cycle count that stops moving
+    failures = []
+    last_cycle, last_progress = 0, time.perf_counter()
+    while feed_thread.is_alive():
+        feed_thread.join(1)
+        if clock.cycle != last_cycle:
+            last_cycle, last_progress = clock.cycle, time.perf_counter()
+        elif time.perf_counter() - last_progress > STALL_TIMEOUT:
+            failures.append(f"feed stalled for {STALL_TIMEOUT} s at cycle {clock.cycle}")
+            break
+    elapsed = time.perf_counter() - started
+    if errors:
+        failures.append(f"feed loop crashed: {errors[0]!r}")
+
+    # Let in-flight connections finish before reading the counters
+    time.sleep(0.5)
+    feature_server.close()
+    tak_server.close()
+
+    print(f"Ran {clock.cycle} cycles in {elapsed:.1f} s ({clock.offset / 86400:.1f} virtual days)")
+    print(f"FeatureServer: {feature_server.queries} queries, {feature_server.faults} injected faults")
+
+    ingest_time = (tak_server.last_event - tak_server.first_event) if tak_server.events > 1 else 0
+    print(f"TAK listener: {tak_server.events} events over {tak_server.connections} connections, "
+          f"{tak_server.dropped} dropped, {tak_server.events / ingest_time if ingest_time else 0:.0f} events/s")
+    if tak_server.latencies:
+        latencies = sorted(tak_server.latencies)
+        print(f"Latency fetch to ingest: p50 {latencies[len(latencies) // 2] * 1000:.1f} ms, "
+              f"p95 {latencies[int(len(latencies) * 0.95)] * 1000:.1f} ms, max {latencies[-1] * 1000:.1f} ms")
+    print(f"Delivery: {feed.events_sent} events marked as sent, {len(feed.missing_uids)} missing at the listener")
+    if feed.missing_uids:
+        failures.append(f"{len(feed.missing_uids)} events marked as sent never reached the TAK listener, "
+                        f"uids {', '.join(feed.missing_uids[:10])}")
+    if not feed.events_sent:
+        failures.append("the feed never marked an event as sent")
+
+    report = growth_report(samples)
+    if report is None:
+        failures.append(f"not enough samples for a growth check, the feed stopped at cycle {clock.cycle}")
+    else:
+        rss_growth, early_cpu, late_cpu, cpu_ratio = report
+        print(f"RSS growth: {rss_growth:+.1f} MB (limit {RSS_GROWTH_LIMIT_MB} MB)")
+        print(f"CPU per 1000 input vertices: {early_cpu * 1e6:.1f} ms -> {late_cpu * 1e6:.1f} ms "
+              f"(x{cpu_ratio:.2f}, limit x{CPU_GROWTH_LIMIT})")
+        if rss_growth > RSS_GROWTH_LIMIT_MB:
+            failures.append(f"RSS grew {rss_growth:.1f} MB")
+        if cpu_ratio > CPU_GROWTH_LIMIT:
+            failures.append(f"CPU per input vertex grew x{cpu_ratio:.2f}")
+
+    if failures:
+        print("FAILED: " + "; ".join(failures))
+    else:
+        print("PASSED")
+    return failures
+
+
+def main():
+    failed = [feed_config["script"] for feed_config in FEEDS if soak(feed_config)]
+    if failed:
+        print(f"Soak failed for {', '.join(failed)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()